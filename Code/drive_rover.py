@@ -9,6 +9,8 @@ import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
+import eventlet.semaphore
+from eventlet import tpool
 from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
@@ -16,6 +18,8 @@ import json
 import pickle
 import matplotlib.image as mpimg
 import time
+import traceback
+import multiprocessing
 import keyboard
 
 # Import functions for perception and decision making
@@ -78,92 +82,216 @@ class RoverState():
         self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
         self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
         self.send_pickup = False # Set to True to trigger rock pickup
-# Initialize our rover 
-Rover = RoverState()
+        # Pose and image signature of the last frame that went through
+        # the full perception pipeline, used to skip unchanged frames
+        self.last_pose = None
+        self.last_signature = None
+        self.pos_change_thresh = 0.05 # Position change (meters) that counts as moving
+        self.angle_change_thresh = 0.5 # Yaw/pitch/roll change (degrees) that counts as moving
+        self.img_change_thresh = 2 # Mean signature difference that counts as a new image
+# Rover state for every connected simulator, keyed by Socket.IO session id
+rovers = {}
 
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+# Variables to track frames per second (FPS) for every session
+# Each entry holds [frame counter, second counter, fps]
+fps_counters = {}
+
+# Optional pool of worker processes, filled in when --workers is given
+# Each session is pinned to one worker which keeps that session's RoverState
+# Every entry holds [pipe to the worker, lock, worker process]
+workers = []
+session_workers = {}
+
+
+# Run one telemetry frame through the rover pipeline and work out the reply
+# Returns the updated Rover and an (event, data) pair to send back
+def drive_step(sid, Rover, data, toggle_debug, image_folder):
+    # Initialize / update Rover with current telemetry
+    Rover, image = update_rover(Rover, data)
+    if toggle_debug:
+        if Rover.debug == 0:
+            Rover.debug = 1
+        else:
+            Rover.debug = 0
+    if np.isfinite(Rover.vel):
+
+        # Execute the perception and decision steps to update the Rover's state
+        Rover = perception_step(Rover)
+        Rover = decision_step(Rover)
+
+        # Create output images to send to server
+        out_image_string1, out_image_string2 = create_output_images(Rover)
+
+        # The action step!  Send commands to the rover!
+
+        # Don't send both of these, they both trigger the simulator
+        # to send back new telemetry so we must only send one
+        # back in respose to the current telemetry data.
+
+        # If in a state where want to pickup a rock send pickup command
+        if Rover.send_pickup and not Rover.picking_up:
+            reply = ('pickup', None)
+            # Reset Rover flags
+            Rover.send_pickup = False
+        else:
+            # Send commands to the rover!
+            commands = (Rover.throttle, Rover.brake, Rover.steer)
+            reply = ('data', (commands, out_image_string1, out_image_string2))
+
+    # In case of invalid telemetry, send null commands
+    else:
+
+        # Send zeros for throttle, brake and steer and empty images
+        reply = ('data', ((0, 0, 0), '', ''))
+
+    # If you want to save camera images from autonomous driving specify a path
+    # Example: $ python drive_rover.py image_folder_path
+    # Conditional to save image frame if folder was specified
+    if image_folder != '':
+        timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+        image_filename = os.path.join(image_folder, '{}_{}'.format(sid, timestamp))
+        image.save('{}.jpg'.format(image_filename))
+
+    return Rover, reply
+
+
+# Define the loop run by every worker process
+# It owns the RoverState of all sessions pinned to it and answers
+# one telemetry frame at a time over its end of the pipe
+def session_worker(conn):
+    worker_rovers = {}
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        sid, data, toggle_debug, image_folder = message
+        # A None payload means the session disconnected
+        if data is None:
+            worker_rovers.pop(sid, None)
+            continue
+        if sid not in worker_rovers:
+            worker_rovers[sid] = RoverState()
+        # A bad frame only loses that frame, like in the server process,
+        # instead of killing the worker and every session pinned to it
+        try:
+            worker_rovers[sid], reply = drive_step(sid, worker_rovers[sid], data,
+                                                   toggle_debug, image_folder)
+        except Exception:
+            traceback.print_exc()
+            reply = ('data', ((0, 0, 0), '', ''))
+        conn.send(reply)
+
+
+# Define a function to start one worker process
+# Returns the parent end of its pipe and the process handle
+def start_worker():
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=session_worker, args=(child_conn,))
+    process.daemon = True
+    process.start()
+    return parent_conn, process
+
+# Define a function to start the worker processes
+def start_workers(count):
+    for _ in range(count):
+        conn, process = start_worker()
+        # The lock keeps request and reply paired up on the shared pipe
+        workers.append([conn, eventlet.semaphore.Semaphore(), process])
+
+# Define a function to replace a worker that died
+# Must be called with the worker's lock held; the lock is kept so
+# sessions waiting on it pick up the new pipe. The sessions pinned to
+# the worker start again from a fresh RoverState.
+def restart_worker(index):
+    conn, lock, process = workers[index]
+    print("Worker {} died, restarting it".format(index))
+    conn.close()
+    process.join(timeout=1)
+    workers[index][0], workers[index][2] = start_worker()
+
+# Define a function to stop the worker processes on shutdown
+def stop_workers():
+    for conn, lock, process in workers:
+        try:
+            conn.send(None)
+        except (EOFError, OSError):
+            pass
+        process.join(timeout=1)
 
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
-    global frame_counter, second_counter, fps
-    frame_counter+=1
+    counter = fps_counters.setdefault(sid, [0, time.time(), None])
+    counter[0] += 1
     # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    if (time.time() - counter[1]) > 1:
+        counter[2] = counter[0]
+        counter[0] = 0
+        counter[1] = time.time()
+    print("Current FPS ({}): {}".format(sid, counter[2]))
 
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-        if keyboard.is_pressed('m'):
-            if Rover.debug == 0:
-                Rover.debug = 1
-            else:
-                Rover.debug = 0
-        if np.isfinite(Rover.vel):
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
- 
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+        toggle_debug = keyboard.is_pressed('m')
+        if workers:
+            # Hand the frame to the worker that owns this session
+            # and wait for its reply without blocking other sessions
+            index = session_workers[sid]
+            with workers[index][1]:
+                try:
+                    conn = workers[index][0]
+                    conn.send((sid, data, toggle_debug, args.image_folder))
+                    event, payload = tpool.execute(conn.recv)
+                except (EOFError, OSError):
+                    restart_worker(index)
+                    # Send null commands so the simulator asks again
+                    event, payload = 'data', ((0, 0, 0), '', '')
         else:
+            if sid not in rovers:
+                rovers[sid] = RoverState()
+            rovers[sid], (event, payload) = drive_step(sid, rovers[sid], data,
+                                                       toggle_debug, args.image_folder)
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        if event == 'pickup':
+            send_pickup(sid)
+        else:
+            commands, out_image_string1, out_image_string2 = payload
+            send_control(sid, commands, out_image_string1, out_image_string2)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    if workers:
+        # Put the new session on the worker with the fewest live sessions
+        load = [0] * len(workers)
+        for index in session_workers.values():
+            load[index] += 1
+        session_workers[sid] = load.index(min(load))
+    send_control(sid, (0, 0, 0), '', '')
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    rovers.pop(sid, None)
+    fps_counters.pop(sid, None)
+    if sid in session_workers:
+        index = session_workers.pop(sid)
+        with workers[index][1]:
+            try:
+                workers[index][0].send((sid, None, False, ''))
+            except (EOFError, OSError):
+                restart_worker(index)
 
-def send_control(commands, image_string1, image_string2):
+def send_control(sid, commands, image_string1, image_string2):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -176,16 +304,16 @@ def send_control(commands, image_string1, image_string2):
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(sid):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -196,6 +324,12 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Number of worker processes to spread simulator sessions over. 0 runs every session in the server process.'
+    )
     args = parser.parse_args()
     # Specify destination folder to save into
     args.image_folder = '../IMG_RUN'
@@ -211,9 +345,16 @@ if __name__ == '__main__':
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
+
+    if args.workers > 0:
+        print("Starting {} worker processes ...".format(args.workers))
+        start_workers(args.workers)
     
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        stop_workers()
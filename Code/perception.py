@@ -109,8 +109,42 @@ def find_rocks(img,Rock_thresh=(100,100,60)):
     return color_select
 
 
+# Define a function to get a cheap signature of the camera image
+# A small grayscale thumbnail is enough to tell whether the view changed
+def image_signature(img, size=(32, 16)):
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+# Define a function to compare two angles in degrees across the 0/360 wrap
+def angle_diff(a, b):
+    return abs((a - b + 180) % 360 - 180)
+
+# Define a function to decide whether the current frame differs enough
+# from the last processed one to be worth running the pipeline on
+def frame_changed(Rover, pose, signature):
+    if Rover.last_pose is None or Rover.last_signature is None:
+        return True
+    (x, y), angles = pose
+    (last_x, last_y), last_angles = Rover.last_pose
+    if np.hypot(x - last_x, y - last_y) > Rover.pos_change_thresh:
+        return True
+    for angle, last_angle in zip(angles, last_angles):
+        if angle_diff(angle, last_angle) > Rover.angle_change_thresh:
+            return True
+    return np.mean(np.abs(signature - Rover.last_signature)) > Rover.img_change_thresh
+
+
 # Apply the above functions in succession and update the Rover state accordingly
 def perception_step(Rover):
+    # 0) Skip the frame if the rover has not moved and the view is the same
+    # The cached nav angles/distances stay valid and the worldmap is not
+    # fed the same pixels again
+    pose = ((Rover.pos[0], Rover.pos[1]), (Rover.yaw, Rover.pitch, Rover.roll))
+    signature = image_signature(Rover.img)
+    if not frame_changed(Rover, pose, signature):
+        return Rover
+    Rover.last_pose = pose
+    Rover.last_signature = signature
     # Perform perception steps to update Rover()
     # TODO: 
     # NOTE: camera image is coming to you in Rover.img